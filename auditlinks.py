@@ -23,11 +23,13 @@ import ipaddress
 import itertools
 import json
 from operator import itemgetter
+import os
+import re
 import requests
 import sys
 import time
 import tldextract
-from urllib.parse import urlparse
+from urllib.parse import urlparse, urlsplit, urlunsplit
 import validators
 
 LANG_SUFFIXES = ('/ab', '/abs', '/ace', '/ady', '/ady-cyrl', '/aeb', '/aeb-arab', '/aeb-latn', '/af', '/ak', '/aln',
@@ -95,6 +97,25 @@ DUMP_FILE = "dump.json"
 RESULT_NOHTTPS_FILE = "result_nohttps.mediawiki"
 # Contains the MediaWiki-formatted list of broken HTTP(S) external links.
 RESULT_BROKEN_FILE = "result_broken.mediawiki"
+# Contains the MediaWiki-formatted list of HTTP(S) external links left untested because the time budget was exceeded.
+RESULT_UNTESTED_FILE = "result_untested.mediawiki"
+# Contains the JSON-formatted history of the previous link tests (used to prioritize links).
+HISTORY_FILE = "history.json"
+
+# Default ports, which are removed from URLs when normalizing them.
+DEFAULT_PORTS = {
+    "http": 80,
+    "https": 443
+}
+
+# Query parameters used for tracking, which are removed from URLs
+# when normalizing them, if requested (see "--strip-tracking-parameters").
+# Note: Parameters starting with "utm_" are also removed.
+TRACKING_PARAMETERS = ("_ga", "dclid", "fbclid", "gclid", "igshid", "mc_cid", "mc_eid", "msclkid", "yclid")
+
+# Unreserved characters (RFC 3986), which are decoded
+# when percent-encoded in URLs when normalizing them.
+UNRESERVED_CHARACTERS = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-._~"
 
 class TestResult(Enum):
     CHUNKEDENCODINGERROR = "Chunked encoding error"        
@@ -118,6 +139,56 @@ class TestResult(Enum):
     NOHTTPS_HTTPS_REQUESTEXCEPTION = f"HTTPS maybe available, but \"{REQUESTEXCEPTION}\" when requested"
     NOHTTPS_HTTPS_TOOMANYREDIRECTS = f"HTTPS available, but \"{TOOMANYREDIRECTS}\" when requested"
 
+# Returns the canonical form of an URL, so that URLs that
+# target the same resource are tested only once.
+# Note: The fragment is removed, since it's never sent to the server ;
+#       the scheme and the host are lower-cased ; the default port is removed ;
+#       an empty path is replaced by "/" ; percent-encoded unreserved characters
+#       are decoded, and other percent-encodings are upper-cased ;
+#       if requested, tracking query parameters are removed.
+# Note: URLs that can't be parsed, or that contain invalid percent-encodings,
+#       are returned unchanged, so that they are tested (or reported as invalid URLs) as they are.
+def normalize_url(url, strip_tracking_parameters=False):
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return url
+
+    if parts.hostname is None:
+        return url
+
+    scheme = parts.scheme.lower()
+
+    netloc = parts.hostname if ":" not in parts.hostname else f"[{parts.hostname}]"
+    if port is not None \
+   and port != DEFAULT_PORTS.get(scheme):
+        netloc += f":{port}"
+    if "@" in parts.netloc:
+        netloc = parts.netloc.rpartition("@")[0] + "@" + netloc
+
+    # Checks whether the path or the query contains a "%"
+    # that doesn't start a valid percent-encoding.
+    # Note: Without this, a stray "%" followed by a valid percent-encoding
+    #       (ex: "%%41") would be changed into another one (ex: "%A").
+    if re.search(r"%(?![0-9A-Fa-f]{2})", parts.path) \
+    or re.search(r"%(?![0-9A-Fa-f]{2})", parts.query):
+        return url
+
+    def normalize_percent_encoding(match):
+        character = chr(int(match.group(1), 16))
+        return character if character in UNRESERVED_CHARACTERS else match.group(0).upper()
+
+    path = re.sub(r"%([0-9A-Fa-f]{2})", normalize_percent_encoding, parts.path) or "/"
+    query = re.sub(r"%([0-9A-Fa-f]{2})", normalize_percent_encoding, parts.query)
+
+    if strip_tracking_parameters:
+        query = "&".join([parameter for parameter in query.split("&")
+                          if not (parameter.partition("=")[0].lower().startswith("utm_")
+                               or parameter.partition("=")[0].lower() in TRACKING_PARAMETERS)])
+
+    return urlunsplit((scheme, netloc, path, query, ""))
+
 #
 # Handles arguments.
 #
@@ -142,6 +213,30 @@ general_group.add_argument("--wait-time",
                            type=int,
                            default=10,
                            help="The wait time in seconds between network requests on the same host. (default: 10)")
+general_group.add_argument("--strip-tracking-parameters",
+                           action="store_true",
+                           help="Removes tracking query parameters (\"utm_*\", \"fbclid\", \"gclid\", ...) from links before testing them.")
+
+priority_group = parser.add_argument_group("Priority options")
+priority_group.add_argument("--time-budget",
+                            metavar="DURATION",
+                            type=int,
+                            help="The maximum duration in seconds of the audit. Once exceeded, no more links are tested, and the links left untested are saved into a file (see \"Filenames options\"). Links are tested by decreasing priority (see the other \"Priority options\"). (default: no limit)")
+priority_group.add_argument("--references-weight",
+                            metavar="WEIGHT",
+                            type=float,
+                            default=1,
+                            help="The weight, in the priority of a link, of the number of wiki pages that reference it. (default: %(default)s)")
+priority_group.add_argument("--age-weight",
+                            metavar="WEIGHT",
+                            type=float,
+                            default=1,
+                            help="The weight, in the priority of a link, of the number of days since it was last tested. (default: %(default)s)")
+priority_group.add_argument("--failure-weight",
+                            metavar="WEIGHT",
+                            type=float,
+                            default=10,
+                            help="The weight, in the priority of a link, of it being broken when it was last tested. (default: %(default)s)")
 
 filenames_group = parser.add_argument_group("Filenames options")
 filenames_group.add_argument("--dump-file",
@@ -156,6 +251,14 @@ filenames_group.add_argument("--result-broken-file",
                              metavar="FILE",
                              default=RESULT_BROKEN_FILE,
                              help=f"The MediaWiki-formatted result file in which will be saved the list of broken HTTP(S) external links. (default: \"%(default)s\")")
+filenames_group.add_argument("--result-untested-file",
+                             metavar="FILE",
+                             default=RESULT_UNTESTED_FILE,
+                             help=f"The MediaWiki-formatted result file in which will be saved the list of HTTP(S) external links left untested because the time budget was exceeded. (default: \"%(default)s\")")
+filenames_group.add_argument("--history-file",
+                             metavar="FILE",
+                             default=HISTORY_FILE,
+                             help=f"The JSON-formatted file from which will be loaded, and in which will be saved, the history of the link tests. (default: \"%(default)s\")")
 
 args = parser.parse_args()
 
@@ -164,11 +267,29 @@ if args.wait_time < 0:
     print(f"Error while handling arguments : argument --wait-time: invalid positive or null int value: '{args.wait_time}'.")
     sys.exit(1)
 
+if args.time_budget is not None \
+and args.time_budget <= 0:
+    parser.print_usage()
+    print(f"Error while handling arguments : argument --time-budget: invalid positive int value: '{args.time_budget}'.")
+    sys.exit(1)
+
+for weight_arg in ["references_weight", "age_weight", "failure_weight"]:
+    if not math.isfinite(getattr(args, weight_arg)) \
+    or getattr(args, weight_arg) < 0:
+        parser.print_usage()
+        print(f"Error while handling arguments : argument --{weight_arg.replace('_', '-')}: invalid finite positive or null float value: '{getattr(args, weight_arg)}'.")
+        sys.exit(1)
+
+# The date after which no more links are tested.
+# Note: The time spent fetching links is included,
+#       so that the whole audit fits in the time budget.
+deadline = time.time() + args.time_budget if args.time_budget is not None else None
+
 #
 # Creates/truncates output files.
 #
 
-for output_file in [args.dump_file, args.result_nohttps_file, args.result_broken_file]:
+for output_file in [args.dump_file, args.result_nohttps_file, args.result_broken_file, args.result_untested_file]:
     if output_file == args.dump_file \
    and args.from_dump_file:
         continue
@@ -376,6 +497,60 @@ else:
 
     print("        Saved.")
 
+#
+# Loads the history of the previous link tests.
+#
+
+# A dictionary of dictionaries, of the form :
+#   {<external link's canonical URL>: {"last_tested": <last test date>, "failed": <whether it was broken>}, ...}
+# Note: Links are normalized when loading the history,
+#       so that histories saved with other normalization options
+#       (or before links were normalized) remain usable.
+#       However, links whose tracking query parameters were removed
+#       can't be matched anymore when "--strip-tracking-parameters" isn't used.
+history = {}
+
+print(f"----- Loading history from file ({args.history_file}) ...")
+
+try:
+    f = open(args.history_file, "r", encoding="utf-8")
+except FileNotFoundError:
+    print("        No history yet.")
+except OSError as e:
+    print(f"        Error while opening \"{args.history_file}\" : {e.strerror}")
+    sys.exit(1)
+else:
+    with f:
+        # Note: The file may be corrupt if it was modified by hand ;
+        #       in that case, the history is simply ignored.
+        # Note: ValueError covers both invalid JSON data and invalid UTF-8 data.
+        try:
+            history_raw = json.load(f)
+        except ValueError:
+            history_raw = None
+
+        if not isinstance(history_raw, dict):
+            print(f"        Error while loading \"{args.history_file}\" : invalid history data. Ignoring the history.")
+        else:
+            # Normalizes links, keeping the most recent test
+            # for links that are duplicates once normalized.
+            # Note: Invalid entries are skipped.
+            for extlink, entry in history_raw.items():
+                if not isinstance(entry, dict) \
+                or not isinstance(entry.get("last_tested"), (int, float)) \
+                or isinstance(entry["last_tested"], bool) \
+                or not math.isfinite(entry["last_tested"]) \
+                or not isinstance(entry.get("failed", False), bool):
+                    continue
+
+                extlink = normalize_url(extlink, args.strip_tracking_parameters)
+
+                if extlink not in history \
+                or entry["last_tested"] > history[extlink]["last_tested"]:
+                    history[extlink] = entry
+
+            print(f"        Loaded history for {len(history)} HTTP(S) external links.")
+
 #
 # Initializes the variables that will be used when testing links.
 #
@@ -399,12 +574,27 @@ nohttps_extlinks = {}
 # A dictionary of strings, of the form :
 #   {<external link's URL>: <test result string>, ...}
 special_extlinks = {}
+# A dictionary of floats, of the form :
+#   {<external link's URL>: <priority>, ...}
+# Higher priority links are tested first.
+priorities = {}
+# A dictionary of strings, of the form :
+#   {<external link's raw URL>: <external link's canonical URL>, ...}
+# Note: Only canonical URLs are tested, and the results
+#       (which are stored for canonical URLs in the dictionaries above)
+#       are reported for each raw URL.
+canonical_extlinks = {}
 
 # Gets the list of links.
 extlinks = list(itertools.chain.from_iterable([page[1] for page in wiki_pages_clean]))
 extlinks_count_raw = len(extlinks)
 # Removes duplicates from the list.
 extlinks = list(set(extlinks))
+extlinks_count_unique_raw = len(extlinks)
+# Normalizes links, and removes the duplicates that appear.
+for extlink in extlinks:
+    canonical_extlinks[extlink] = normalize_url(extlink, args.strip_tracking_parameters)
+extlinks = list(set(canonical_extlinks.values()))
 extlinks_count_unique = len(extlinks)
 
 # Fills "hosts" variable, and takes care of some special cases.
@@ -442,10 +632,53 @@ for extlink in extlinks:
 extlinks_count_tobetested = extlinks_count_unique - len(special_extlinks) - len(broken_extlinks)
 digits_count = len(str(extlinks_count_tobetested))
 
+# Fills "priorities" variable.
+# Note: The priority of a link is the weighted sum of
+#       the number of wiki pages that reference it,
+#       the number of days since it was last tested,
+#       and whether it was broken when it was last tested.
+#       Links that were never tested are considered
+#       as old as the oldest tested link.
+references_counts = {}
+for page in wiki_pages_clean:
+    for link in set([canonical_extlinks[link] for link in page[1]]):
+        references_counts[link] = references_counts.get(link, 0) + 1
+
+# Removes from the history the links that are not on the wiki anymore.
+# Note: Without this, the history file (which is saved after each test)
+#       would keep growing from one audit to the next.
+# Note: This is only done when links were fetched from the MediaWiki Action API,
+#       since a dump file may be partial or old, and the history of
+#       the links it doesn't contain would otherwise be lost.
+if not args.from_dump_file:
+    history = {extlink: history[extlink] for extlink in extlinks if extlink in history}
+
+now = time.time()
+ages = {extlink: (now - history[extlink]["last_tested"]) / 86400 for extlink in extlinks if extlink in history}
+max_age = max(ages.values(), default=0)
+
+for extlink in extlinks:
+    priorities[extlink] = args.references_weight * references_counts[extlink] \
+                        + args.age_weight * ages.get(extlink, max_age) \
+                        + args.failure_weight * history.get(extlink, {}).get("failed", False)
+
+# Sorts each host's list of links by decreasing priority.
+for host in hosts.values():
+    host[1].sort(key=lambda extlink: priorities[extlink], reverse=True)
+
 # Fills "hosts_sorted" variable.
 hosts_sorted = [[k, v[1], v[0]] for k, v in hosts.items()]
 # Sorts the list by decreasing size of links lists.
-hosts_sorted.sort(key=lambda host: len(host[1]), reverse=True)
+# Note: With a time budget, not all links may be tested,
+#       so the list is instead sorted by decreasing priority of
+#       the next link to be tested of each host (the first one,
+#       since each host's list of links is sorted by decreasing priority),
+#       so that the most valuable links are tested first,
+#       even when they are from hosts with few links.
+if deadline is None:
+    hosts_sorted.sort(key=lambda host: len(host[1]), reverse=True)
+else:
+    hosts_sorted.sort(key=lambda host: priorities[host[1][0]], reverse=True)
 
 #
 # Displays links summary.
@@ -453,11 +686,14 @@ hosts_sorted.sort(key=lambda host: len(host[1]), reverse=True)
 
 print("----- Testing links ...")
 print(f"        {extlinks_count_raw} HTTP(S) external links.")
-print(f"            {round(100*((extlinks_count_raw-extlinks_count_unique)/extlinks_count_raw))} % are duplicates.")
+print(f"            {round(100*((extlinks_count_raw-extlinks_count_unique)/extlinks_count_raw))} % are duplicates ({extlinks_count_unique_raw-extlinks_count_unique} unique HTTP(S) external links are duplicates only once normalized).")
 print(f"        {extlinks_count_unique} unique HTTP(S) external links.")
 print(f"            {len(special_extlinks)} are special URLs (\"localhost\", multicast IP addresses, private IP addresses, ...).")
 print(f"            {len(broken_extlinks)} are invalid URLs.")
-print(f"        {extlinks_count_tobetested} unique HTTP(S) external links to be tested.\n")
+print(f"        {extlinks_count_tobetested} unique HTTP(S) external links to be tested.")
+if deadline is not None:
+    print(f"            {max(0, round(deadline - time.time()))} seconds remain in the time budget.")
+print()
 
 #
 # Tests links.
@@ -465,6 +701,8 @@ print(f"        {extlinks_count_tobetested} unique HTTP(S) external links to be
 
 extlinks_count = 0
 
+budget_exceeded = False
+
 while True:
     start_time = time.time()
 
@@ -475,6 +713,12 @@ while True:
         http_status_code = None
         request_time = time.time()
 
+        # Checks whether the time budget is exceeded.
+        if deadline is not None \
+       and request_time >= deadline:
+            budget_exceeded = True
+            break
+
         # Checks whether not enough time has passed since the last request to the host of the currently tested link.
         if request_time - host[2] < args.wait_time:
             continue
@@ -566,6 +810,12 @@ while True:
             else:
                 broken_extlinks[extlink] = result_s
 
+        # Updates the history of the currently tested link.
+        history[extlink] = {
+            "last_tested": request_time,
+            "failed": extlink in broken_extlinks
+        }
+
         # Updates the time of the last request to the host of the currently tested link.
         host[2] = request_time
 
@@ -576,6 +826,9 @@ while True:
         # Saves audit results into files.
         # Note: It takes between 0.001 and 0.01 second to do that,
         #       so it's not a problem to do it after each test.
+        # Note: Saving the history takes more time (around 0.06 second
+        #       for 13000 links), but it remains small compared to a test,
+        #       and the history only contains links that are on the wiki.
         #
 
         for extlinks_list, output_file in [(nohttps_extlinks, args.result_nohttps_file),
@@ -591,13 +844,32 @@ while True:
                         to_write = ""
 
                         for link in page[1]:
-                            if link in extlinks_list:
-                                to_write += f"[{link}] : {extlinks_list[link]}\n\n"
+                            if canonical_extlinks[link] in extlinks_list:
+                                to_write += f"[{link}] : {extlinks_list[canonical_extlinks[link]]}\n\n"
 
                         if to_write:
                             f.write(f"== [[:{page[0]}]] ==\n\n")
                             f.write(to_write)
 
+        # Note: The history is first saved into a temporary file,
+        #       which then replaces the history file, so that
+        #       an interruption while saving it can't corrupt it.
+        history_file_tmp = f"{args.history_file}.tmp"
+
+        try:
+            f = open(history_file_tmp, "w", encoding="utf-8")
+        except OSError as e:
+            print(f"        Error while opening \"{history_file_tmp}\" : {e.strerror}")
+            sys.exit(1)
+        with f:
+            json.dump(history, f)
+
+        try:
+            os.replace(history_file_tmp, args.history_file)
+        except OSError as e:
+            print(f"        Error while replacing \"{args.history_file}\" : {e.strerror}")
+            sys.exit(1)
+
         # Checks whether enough time has passed to make
         # another request to the first host tested by this "for" loop.
         # Note: This is needed in order to test as many links
@@ -619,27 +891,40 @@ while True:
         if time.time() - start_time >= 1.1*args.wait_time:
             break
 
+    if budget_exceeded:
+        break
+
     # Checks whether the remaining lists of links to be tested are empty.
     if all([not host[1] for host in hosts_sorted]):
         break
 
     # Removes hosts that don't have external links to be tested anymore.
     hosts_sorted = [host for host in hosts_sorted if host[1]]
-    # Sorts the list by decreasing size of links lists.
+    # Sorts the list by decreasing size of links lists
+    # (or, with a time budget, by decreasing priority of
+    # the next link to be tested of each host).
     # Note: This is needed in case we "break" from the "for" loop,
     #       since some tested hosts' list of links may now have,
     #       after the link testing, one less element than
     #       the following untested host's list of links,
     #       if they initially had the same number of links to be tested.
+    #       With a time budget, the next link to be tested of
+    #       the tested hosts has also changed, and it may now have
+    #       a lower priority than the ones of the following untested hosts,
+    #       which must then be tested first.
     # Note: Since sort() is "stable", sorting will not change
     #       the relative order of elements that compare equal.
     #       It means than even if the tested hosts' list of links
-    #       and the following untested host's list of links have the same length,
+    #       and the following untested host's list of links have the same length
+    #       (or next links with the same priority),
     #       sort() will not put some tested ones several positions later
     #       in the list than some untested ones, which would otherwise
     #       make us uselessly wait some time for tested ones
     #       that we wouldn't actually reach on the next "for" loop.
-    hosts_sorted.sort(key=lambda host: len(host[1]), reverse=True)
+    if deadline is None:
+        hosts_sorted.sort(key=lambda host: len(host[1]), reverse=True)
+    else:
+        hosts_sorted.sort(key=lambda host: priorities[host[1][0]], reverse=True)
 
     #
     # Ensures enough time has passed
@@ -656,6 +941,12 @@ while True:
 
     delay = time.time() - start_time
 
+    # Checks whether the time budget would be exceeded while waiting.
+    if deadline is not None \
+   and start_time + wait_time >= deadline:
+        budget_exceeded = True
+        break
+
     if delay < wait_time:
         sleep_time = wait_time - delay
         sleep_time_floored = math.floor(sleep_time)
@@ -668,21 +959,59 @@ while True:
             print(".", end="", flush=True)
         print("\n", end="", flush=True)
 
+#
+# Saves the links left untested into file.
+#
+
+# A dictionary of strings, of the form :
+#   {<external link's URL>: <test result string>, ...}
+untested_extlinks = {}
+
+if budget_exceeded:
+    print()
+    print("----- Time budget exceeded.")
+
+    for host in hosts_sorted:
+        for extlink in host[1]:
+            untested_extlinks[extlink] = f"Not tested (priority: {round(priorities[extlink], 1)})"
+
+    try:
+        f = open(args.result_untested_file, "w", encoding="utf-8")
+    except OSError as e:
+        print(f"        Error while opening \"{args.result_untested_file}\" : {e.strerror}")
+        sys.exit(1)
+    with f:
+        for page in wiki_pages_clean:
+            to_write = ""
+
+            for link in page[1]:
+                if canonical_extlinks[link] in untested_extlinks:
+                    to_write += f"[{link}] : {untested_extlinks[canonical_extlinks[link]]}\n\n"
+
+            if to_write:
+                f.write(f"== [[:{page[0]}]] ==\n\n")
+                f.write(to_write)
+
 #
 # Displays results summary.
 #
 
 count_broken_extlinks = 0
 count_nohttps_extlinks = 0
+count_untested_extlinks = 0
 
 for page in wiki_pages_clean:
     for link in page[1]:
-        if link in nohttps_extlinks:
+        if canonical_extlinks[link] in nohttps_extlinks:
             count_nohttps_extlinks += 1
-        if link in broken_extlinks:
+        if canonical_extlinks[link] in broken_extlinks:
             count_broken_extlinks += 1
+        if canonical_extlinks[link] in untested_extlinks:
+            count_untested_extlinks += 1
 
 print()
 print("----- Results:")
 print(f"        {count_broken_extlinks} broken HTTP(S) external links.")
 print(f"        {count_nohttps_extlinks} valid HTTP external links that (may) have an HTTPS version.")
+if budget_exceeded:
+    print(f"        {count_untested_extlinks} HTTP(S) external links left untested ({len(untested_extlinks)} unique).")